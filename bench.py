@@ -0,0 +1,950 @@
+"""Offline benchmarks for stellar.py
+
+Runs against a throwaway SQLite file, never talks to Telegram and prints
+results as JSON so runs can be compared.
+
+    python bench.py memory --users 1000000
+    python bench.py joins --requests 20000 --chats 20 --latency 30
+    python bench.py joins --requests 20000 --chats 20 --shards 4
+    python bench.py starts --requests 20000 --floodwait-rate 0.001
+    python bench.py starts --requests 20000 --invalid-ratio 0.9 --pending-index off
+    python bench.py broadcast --users 100000 --error-rate 0.05
+    python bench.py startup --latency 300
+    python bench.py migrate --users 1000000 --requests 5000
+    python bench.py duplicates --requests 5000 --duplicate-ratio 0.5
+    python bench.py priority --users 20000 --requests 300 --outbound-rate 60 --rate 55
+    python bench.py joins --requests 20000 --storage memory
+    python bench.py floods --requests 1000
+    python bench.py parity --users 20000 --postgres-dsn postgresql://localhost/stellar_bench
+
+``joins``, ``starts`` and ``broadcast`` feed synthetic updates through the
+real handlers with FakeClient standing in for pyrogram's Client. Its
+latency, FloodWait rate and error rate are set from the command line.
+``startup`` times fresh processes from launch to the first join request
+handled, on a new database and again on the one it left behind.
+``duplicates`` replays part of the joins and starts update streams, some
+copies right away and some at the end like a reconnect, and checks that
+every request reaches Telegram once. ``priority`` runs joins alone and then next to a broadcast, both held to
+--outbound-rate by the outbound scheduler, to show what a broadcast costs
+approvals. ``migrate`` runs the joins scenario twice, the second time while a
+background migration rewrites every user row, to show the writer stall.
+``floods`` checks that calls hitting one FloodWait together halve the
+outbound rate once, then runs joins at OUTBOUND_RATE without and with
+--floodwait-rate (2% by default). ``parity`` replays one random sequence of storage calls against the sqlite
+and memory engines, and PostgreSQL when --postgres-dsn (or
+STELLAR_POSTGRES_DSN) is given, and reports every call whose result differs.
+It empties the PostgreSQL tables first, so point it at a scratch database.
+--storage picks the engine the other benchmarks run on.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pyrogram.errors import (
+    FloodWait, PeerIdInvalid, UserChannelsTooMuch, UserIsBlocked, UserNotParticipant
+)
+
+import stellar
+
+IMPORTED = time.time()
+
+def use_temp_database(directory):
+    """Point stellar at a fresh database file inside ``directory``"""
+    stellar.close_database()
+    stellar.DB_NAME = os.path.join(directory, 'bench.db')
+    stellar.init_database()
+
+
+def seed_users(count, batch=50000):
+    """Insert ``count`` synthetic users directly, bypassing the write-behind buffer"""
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    for start in range(1, count + 1, batch):
+        rows = [(user_id, None, f'user{user_id}', now) for user_id in range(start, min(start + batch, count + 1))]
+        stellar.get_storage().write_batch(rows, {})
+
+
+def seed_mutes(pairs, batch=50000):
+    """Insert pending verifications for ``(user_id, chat_id)`` pairs directly"""
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    expires_at = time.time() + stellar.VERIFY_TIMEOUT if stellar.VERIFY_TIMEOUT else None
+    for start in range(0, len(pairs), batch):
+        stellar.get_storage().add_muted_users([
+            (user_id, chat_id, f'chat{chat_id}', now, expires_at)
+            for user_id, chat_id in pairs[start:start + batch]
+        ])
+    # Written behind the index's back, so reload it as a restart would
+    stellar.PENDING.reload()
+
+
+def measure(scan):
+    """Run ``scan`` and return its peak traced memory, duration and time to first id"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    first, seen = asyncio.run(scan())
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'users_seen': seen,
+        'peak_mib': round(peak / 2 ** 20, 2),
+        'seconds': round(elapsed, 3),
+        'first_id_ms': round((first - start) * 1000, 2),
+    }
+
+
+async def scan_materialized():
+    """Full scan by loading every user id into a list first"""
+    users = await stellar.run_db(stellar.get_all_users)
+    first = time.perf_counter()
+    seen = 0
+    for _ in users:
+        seen += 1
+    return first, seen
+
+
+async def scan_streaming():
+    """Full scan with the keyset-paginated async generator"""
+    first = None
+    seen = 0
+    async for _ in stellar.iter_user_ids():
+        if first is None:
+            first = time.perf_counter()
+        seen += 1
+    return first, seen
+
+
+def bench_memory(args):
+    with tempfile.TemporaryDirectory() as directory:
+        use_temp_database(directory)
+        seed_users(args.users)
+        result = {
+            'benchmark': 'memory',
+            'users': args.users,
+            'page_size': stellar.USER_PAGE_SIZE,
+            'materialized': measure(scan_materialized),
+            'streaming': measure(scan_streaming),
+        }
+        stellar.close_database()
+    return result
+
+
+# ==================== FAKE TELEGRAM ====================
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f'user{user_id}'
+        self.first_name = f'User {user_id}'
+
+    @property
+    def mention(self):
+        return f'[{self.first_name}](tg://user?id={self.id})'
+
+
+class FakeChat:
+    def __init__(self, chat_id, title=None):
+        self.id = chat_id
+        self.title = title or f'chat{chat_id}'
+
+
+class FakeJoinRequest:
+    def __init__(self, chat, user):
+        self.chat = chat
+        self.from_user = user
+
+
+class FakeMessage:
+    """Just enough of pyrogram's Message for the handlers under test"""
+
+    def __init__(self, client, chat, user=None, text='', message_id=0, reply_to_message=None):
+        self.client = client
+        self.chat = chat
+        self.from_user = user
+        self.text = text
+        self.command = text[1:].split() if text.startswith('/') else []
+        self.id = message_id
+        self.reply_to_message = reply_to_message
+
+    async def reply_text(self, text=None, **kwargs):
+        return await self.client.send_message(self.chat.id, text, **kwargs)
+
+    async def edit_text(self, text=None, **kwargs):
+        await self.client.call('edit_message_text')
+        return self
+
+    async def delete(self):
+        await self.client.call('delete_messages')
+
+
+class FakeClient:
+    """In-process stand-in for pyrogram's Client.
+
+    Every API call sleeps for ``latency`` seconds (+/- 50% jitter). With
+    probability ``floodwait_rate`` it raises FloodWait(``floodwait_seconds``),
+    and with probability ``error_rate`` it raises the error Telegram would
+    send for that method (see ERRORS). ``observer(method, kwargs)`` is called
+    after every successful call.
+    """
+
+    ERRORS = {
+        'approve_chat_join_request': UserChannelsTooMuch,
+        'restrict_chat_member': UserNotParticipant,
+        'send_message': PeerIdInvalid,
+        'copy_message': UserIsBlocked,
+    }
+
+    def __init__(self, latency=0.0, floodwait_rate=0.0, floodwait_seconds=1, error_rate=0.0, seed=0, observer=None):
+        self.latency = latency
+        self.floodwait_rate = floodwait_rate
+        self.floodwait_seconds = floodwait_seconds
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.observer = observer
+        self.message_ids = 0
+        self.calls = {}
+        self.workers = stellar.Bot.workers
+
+    async def call(self, method, **kwargs):
+        counts = self.calls.setdefault(method, {'calls': 0, 'floodwaits': 0, 'errors': 0})
+        counts['calls'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        roll = self.random.random()
+        if roll < self.floodwait_rate:
+            counts['floodwaits'] += 1
+            raise FloodWait(value=self.floodwait_seconds)
+        if method in self.ERRORS and roll < self.floodwait_rate + self.error_rate:
+            counts['errors'] += 1
+            raise self.ERRORS[method]()
+        if self.observer is not None:
+            self.observer(method, kwargs)
+
+    async def start(self):
+        await self.call('start')
+
+    async def stop(self):
+        await self.call('stop')
+
+    async def get_me(self):
+        await self.call('get_me')
+        user = FakeUser(0)
+        user.username = 'bench_bot'
+        return user
+
+    async def approve_chat_join_request(self, chat_id, user_id):
+        await self.call('approve_chat_join_request', chat_id=chat_id, user_id=user_id)
+        return True
+
+    async def restrict_chat_member(self, chat_id, user_id, permissions, until_date=None):
+        await self.call('restrict_chat_member', chat_id=chat_id, user_id=user_id, permissions=permissions)
+        return True
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.call('send_message', chat_id=chat_id)
+        self.message_ids += 1
+        return FakeMessage(self, FakeChat(chat_id), text=text or '', message_id=self.message_ids)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self.call('copy_message', chat_id=chat_id)
+        self.message_ids += 1
+        return FakeMessage(self, FakeChat(chat_id), message_id=self.message_ids)
+
+    async def delete_messages(self, chat_id, message_ids):
+        await self.call('delete_messages', chat_id=chat_id)
+        return True
+
+    async def ban_chat_member(self, chat_id, user_id, until_date=None):
+        await self.call('ban_chat_member', chat_id=chat_id, user_id=user_id)
+
+    async def unban_chat_member(self, chat_id, user_id):
+        await self.call('unban_chat_member', chat_id=chat_id, user_id=user_id)
+
+    async def get_chat(self, chat_id):
+        await self.call('get_chat', chat_id=chat_id)
+        return FakeChat(chat_id)
+
+
+# ==================== HANDLER BENCHMARKS ====================
+
+class WriteCounter:
+    """Counts statements run on stellar's writer connection"""
+
+    WRITES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+
+    def attach(self):
+        stellar.open_database().writer.set_trace_callback(self.trace)
+
+    def trace(self, sql):
+        keyword = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        if keyword in self.WRITES:
+            self.statements += 1
+        elif keyword == 'COMMIT':
+            self.commits += 1
+
+    def report(self):
+        return {'write_statements': self.statements, 'commits': self.commits}
+
+
+def percentiles(values):
+    """count/p50/p95/p99 in milliseconds for a list of seconds"""
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50_ms': round(stellar.percentile(values, 50) * 1000, 3),
+        'p95_ms': round(stellar.percentile(values, 95) * 1000, 3),
+        'p99_ms': round(stellar.percentile(values, 99) * 1000, 3),
+    }
+
+
+def span_report():
+    return {
+        name: {
+            'count': count,
+            'p50_ms': round(p50 * 1000, 3),
+            'p95_ms': round(p95 * 1000, 3),
+            'p99_ms': round(p99 * 1000, 3),
+        }
+        for name, count, total, p50, p95, p99 in stellar.SPANS.summary()
+    }
+
+
+async def dispatch(handler, client, updates, workers):
+    """Feed updates to ``handler`` with a fixed worker pool, like pyrogram's dispatcher"""
+    pending = asyncio.Queue(maxsize=workers * 4)
+    latencies = []
+
+    async def worker():
+        while True:
+            item = await pending.get()
+            try:
+                if item is None:
+                    return
+                queued_at, update = item
+                try:
+                    await handler(client, update)
+                except Exception as e:
+                    stellar.logger.error("Handler error: %s", e)
+                latencies.append(time.monotonic() - queued_at)
+            finally:
+                pending.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    for update in updates:
+        await pending.put((time.monotonic(), update))
+    for _ in tasks:
+        await pending.put(None)
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def configure(args):
+    """Apply the shared command-line settings to stellar before a run"""
+    logging.getLogger().setLevel(args.log_level)
+    stellar.BOT_USERNAME = 'bench_bot'
+    stellar.STORAGE_BACKEND = args.storage
+    stellar.POSTGRES_DSN = args.postgres_dsn
+    stellar.JOIN_RETRY_DELAY = args.retry_delay
+    stellar.SPANS.samples = max(stellar.SPANS.samples, args.requests, args.users)
+    stellar.SPANS.reset()
+    stellar.IDEMPOTENCY = stellar.IdempotencyCache()
+    stellar.OUTBOUND = stellar.OutboundScheduler(
+        rate=args.outbound_rate, chat_intervals={'welcome': args.group_interval} if args.group_interval else {}
+    )
+    stellar.PENDING = stellar.PendingIndex(
+        enabled=args.pending_index != 'off',
+        max_exact=0 if args.pending_index == 'bloom' else stellar.PENDING_INDEX_MAX,
+    )
+
+
+def with_duplicates(args, updates):
+    """Repeat a ``duplicate_ratio`` share of ``updates``.
+
+    Half of the copies follow the original straight away, so both are in
+    flight together; the rest are replayed after the stream, like the
+    redelivery after a reconnect.
+    """
+    rng = random.Random(args.seed + 1)
+    replay = []
+    for update in updates:
+        yield update
+        if rng.random() < args.duplicate_ratio:
+            if rng.random() < 0.5:
+                yield update
+            else:
+                replay.append(update)
+    yield from replay
+
+
+def make_client(args, observer=None):
+    return FakeClient(
+        latency=args.latency / 1000,
+        floodwait_rate=args.floodwait_rate,
+        floodwait_seconds=args.floodwait_seconds,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        observer=observer,
+    )
+
+
+def run_scenario(args, seed, scenario, database=None):
+    """Run ``scenario(args, writes)`` with the write-behind buffer running.
+
+    Uses a fresh database filled by ``seed(args)``, or the existing file
+    ``database`` when shards share one.
+    """
+    configure(args)
+    with tempfile.TemporaryDirectory() as directory:
+        if database is None:
+            use_temp_database(directory)
+            seed(args)
+        else:
+            stellar.close_database()
+            stellar.DB_NAME = database
+            stellar.init_database()
+        writes = WriteCounter()
+
+        async def go():
+            writes.attach()
+            stellar.WRITE_BEHIND.start()
+            stellar.LOG_EVENTS.start()
+            try:
+                return await scenario(args, writes)
+            finally:
+                await stellar.WRITE_BEHIND.stop()
+                await stellar.LOG_EVENTS.stop()
+
+        result = asyncio.run(go())
+        result['sqlite'] = writes.report()
+        result['spans'] = span_report()
+        stellar.close_database()
+    return result
+
+
+async def scenario_joins(args, writes):
+    submitted = {}
+    muted = []
+
+    def observer(method, kwargs):
+        if method == 'restrict_chat_member':
+            muted.append(time.monotonic() - submitted[kwargs['user_id']])
+
+    client = make_client(args, observer)
+    stellar.JOIN_PIPELINE = pipeline = stellar.JoinPipeline()
+    stellar.WELCOMES = stellar.WelcomeCoalescer(window=args.welcome_window)
+    stellar.SWEEPER = stellar.JoinRequestSweeper()
+    chats = [FakeChat(-1000000000000 - i) for i in range(args.chats)]
+
+    def updates():
+        for user_id in range(1, args.requests + 1):
+            chat = chats[user_id % len(chats)]
+            # Stands in for shard_filter, which only pyrogram's dispatcher applies
+            if stellar.SHARDS.mode == 'partitioned':
+                if not stellar.owns_chat(chat.id):
+                    continue
+            elif not stellar.claim_update(f"j:{chat.id}:{user_id}:", stellar.SHARD_INDEX):
+                continue
+            submitted[user_id] = time.monotonic()
+            yield FakeJoinRequest(chat, FakeUser(user_id))
+
+    start = time.perf_counter()
+    await dispatch(stellar.auto_accept_handler, client, with_duplicates(args, updates()), client.workers)
+    while pipeline.queue.qsize() or pipeline.retries or pipeline.queue._unfinished_tasks:
+        await pipeline.queue.join()
+        await asyncio.sleep(0.01)
+    await stellar.WELCOMES.stop()
+    elapsed = time.perf_counter() - start
+    await pipeline.stop()
+
+    return {
+        'benchmark': 'joins',
+        'requests': len(submitted),
+        'chats': args.chats,
+        'shard': stellar.SHARD_INDEX,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(submitted) / elapsed, 1),
+        'request_to_mute': percentiles(muted),
+        'pipeline': pipeline.stats(),
+        'welcomes': stellar.WELCOMES.counters,
+        'idempotency': stellar.IDEMPOTENCY.counters,
+        'client': client.calls,
+    }
+
+
+def seed_starts(args):
+    rng = random.Random(args.seed)
+    chats = [-1000000000000 - i for i in range(args.chats)]
+    args.pairs = [(user_id, rng.choice(chats)) for user_id in range(1, args.requests + 1)]
+    seed_mutes(args.pairs)
+
+
+async def scenario_starts(args, writes):
+    client = make_client(args)
+    rng = random.Random(args.seed)
+
+    def updates():
+        for user_id, chat_id in args.pairs:
+            sender = user_id
+            if rng.random() < args.invalid_ratio:
+                # Half open someone else's link, half a link with nothing pending
+                if rng.random() < 0.5:
+                    sender = user_id + 1
+                else:
+                    chat_id = 1
+            user = FakeUser(sender)
+            yield FakeMessage(client, FakeChat(sender), user, f'/start unmute_{chat_id}_{user_id}')
+
+    start = time.perf_counter()
+    latencies = await dispatch(stellar.start_handler, client, with_duplicates(args, updates()), client.workers)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'benchmark': 'starts',
+        'requests': args.requests,
+        'invalid_ratio': args.invalid_ratio,
+        'pending_index': args.pending_index,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(args.requests / elapsed, 1),
+        'latency': percentiles(latencies),
+        'idempotency': stellar.IDEMPOTENCY.counters,
+        'client': client.calls,
+    }
+
+
+def seed_broadcast(args):
+    seed_users(args.users)
+
+
+async def scenario_broadcast(args, writes):
+    stellar.BROADCAST_RATE = args.rate
+    stellar.BROADCAST_PER_CHAT_INTERVAL = 0
+    client = make_client(args)
+    admin = FakeUser(stellar.OWNER_ID)
+    chat = FakeChat(stellar.OWNER_ID)
+    post = FakeMessage(client, chat, admin, 'announcement', message_id=1)
+    command = FakeMessage(client, chat, admin, '/broadcast', message_id=2, reply_to_message=post)
+
+    start = time.perf_counter()
+    await stellar.broadcast_handler(client, command)
+    elapsed = time.perf_counter() - start
+    job = await stellar.run_db(stellar.get_broadcast_job, 1)
+
+    return {
+        'benchmark': 'broadcast',
+        'users': args.users,
+        'rate_limit': args.rate,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(args.users / elapsed, 1),
+        'job': {key: job[key] for key in ('status', 'total', 'success', 'failed', 'deleted', 'blocked')},
+        'client': client.calls,
+    }
+
+
+def seed_migrate(args):
+    seed_users(args.users)
+    stellar.BACKGROUND_MIGRATIONS['bench_backfill'] = stellar.Backfill('users', 'last_error = NULL')
+    with stellar.get_db() as conn:
+        stellar.queue_background_migration(conn.cursor(), 'bench_backfill')
+
+
+async def scenario_migrate(args, writes):
+    runner = stellar.MigrationRunner()
+    started = time.perf_counter()
+    task = runner.start()
+    result = await scenario_joins(args, writes)
+    await task
+    result['migration_seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def run_join_shard(args, shard, database):
+    """One shard process of a sharded joins run"""
+    stellar.SHARD_COUNT, stellar.SHARD_INDEX = args.shards, shard
+    # Every shard is handed every update, as the delivery probe checks for
+    stellar.SHARDS = stellar.ShardMonitor()
+    stellar.SHARDS.delivery = (args.delivery, 0)
+    return run_scenario(args, None, scenario_joins, database)
+
+
+def bench_joins(args):
+    if args.shards == 1:
+        return run_scenario(args, lambda args: None, scenario_joins)
+
+    # Every shard is its own process on one shared database, as with --shards
+    with tempfile.TemporaryDirectory() as directory:
+        use_temp_database(directory)
+        stellar.close_database()
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(args.shards) as pool:
+            shards = pool.starmap(run_join_shard, [(args, shard, stellar.DB_NAME) for shard in range(args.shards)])
+
+    seconds = max(shard['seconds'] for shard in shards)
+    return {
+        'benchmark': 'joins',
+        'shards': args.shards,
+        'requests': sum(shard['requests'] for shard in shards),
+        'chats': args.chats,
+        'seconds': seconds,
+        'requests_per_second': round(sum(shard['requests'] for shard in shards) / seconds, 1),
+        'sqlite': {
+            key: sum(shard['sqlite'][key] for shard in shards)
+            for key in ('write_statements', 'commits')
+        },
+        'per_shard': shards,
+    }
+
+
+async def startup_child(args):
+    """Body of one ``startup`` process: start the bot, handle one join request"""
+    muted = asyncio.Event()
+    times = {'import': IMPORTED}
+
+    def observer(method, kwargs):
+        if method == 'restrict_chat_member':
+            muted.set()
+
+    client = make_client(args, observer)
+    deferred = await stellar.start_bot(client)
+    times['ready'] = time.time()
+    try:
+        await stellar.auto_accept_handler(client, FakeJoinRequest(FakeChat(-1000000000000), FakeUser(1)))
+        await muted.wait()
+        times['first_update'] = time.time()
+    finally:
+        await stellar.stop_bot(client, deferred)
+        await stellar.SUDO_CACHE.stop()
+        await stellar.WRITE_BEHIND.stop()
+        await stellar.LOG_EVENTS.stop()
+        stellar.close_database()
+    return times
+
+
+def bench_startup(args):
+    """Launch fresh processes and time import, ready and first handled update"""
+    if args.startup_child:
+        configure(args)
+        stellar.DB_NAME = args.startup_child
+        return asyncio.run(startup_child(args))
+
+    runs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'bench.db')
+        command = [sys.executable, os.path.abspath(__file__), 'startup', '--startup-child', database,
+                   '--latency', str(args.latency), '--log-level', args.log_level]
+        # The first run creates the schema, the second finds it at the current version
+        for run in ('cold', 'warm'):
+            launched = time.time()
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            times = json.loads(output)
+            runs[run] = {
+                f'{name}_ms': round((times[name] - launched) * 1000, 1)
+                for name in ('import', 'ready', 'first_update')
+            }
+    return {'benchmark': 'startup', 'latency_ms': args.latency, **runs}
+
+
+async def scenario_priority(args, writes):
+    stellar.BROADCAST_RATE = args.rate
+    stellar.BROADCAST_PER_CHAT_INTERVAL = 0
+    client = make_client(args)
+    admin = FakeUser(stellar.OWNER_ID)
+    chat = FakeChat(stellar.OWNER_ID)
+    post = FakeMessage(client, chat, admin, 'announcement', message_id=1)
+    command = FakeMessage(client, chat, admin, '/broadcast', message_id=2, reply_to_message=post)
+
+    broadcast = asyncio.create_task(stellar.broadcast_handler(client, command))
+    # Let the broadcast take the whole budget before the joins arrive
+    await asyncio.sleep(2)
+    sent = client.calls.get('copy_message', {}).get('calls', 0)
+    result = await scenario_joins(args, writes)
+    result['broadcast_messages_per_second'] = round(
+        (client.calls.get('copy_message', {}).get('calls', 0) - sent) / result['seconds'], 1
+    )
+    await stellar.BROADCASTS.shutdown()
+    try:
+        await broadcast
+    except (asyncio.CancelledError, Exception):
+        pass
+    return result
+
+
+def bench_priority(args):
+    def summary(result):
+        return {
+            'seconds': result['seconds'],
+            'requests_per_second': result['requests_per_second'],
+            'request_to_mute': result['request_to_mute'],
+            'broadcast_messages_per_second': result.get('broadcast_messages_per_second', 0),
+            'outbound_wait': {
+                kind: result['spans'][f'outbound.{kind}']
+                for kind in stellar.OutboundScheduler.PRIORITIES if f'outbound.{kind}' in result['spans']
+            },
+        }
+
+    alone = run_scenario(args, lambda args: None, scenario_joins)
+    shared = run_scenario(args, seed_broadcast, scenario_priority)
+    return {
+        'benchmark': 'priority',
+        'requests': args.requests,
+        'outbound_rate': args.outbound_rate,
+        'broadcast_rate': args.rate,
+        'joins_alone': summary(alone),
+        'joins_during_broadcast': summary(shared),
+    }
+
+
+def bench_duplicates(args):
+    if not args.duplicate_ratio:
+        args.duplicate_ratio = 0.5
+    args.invalid_ratio = args.error_rate = args.floodwait_rate = 0
+    joins = run_scenario(args, lambda args: None, scenario_joins)
+    starts = run_scenario(args, seed_starts, scenario_starts)
+
+    def check(result, method, expected):
+        calls = result['client'].get(method, {}).get('calls', 0)
+        return {'expected': expected, 'calls': calls, 'ok': calls == expected, 'idempotency': result['idempotency']}
+
+    return {
+        'benchmark': 'duplicates',
+        'requests': args.requests,
+        'duplicate_ratio': args.duplicate_ratio,
+        'joins': {
+            'approve': check(joins, 'approve_chat_join_request', joins['requests']),
+            # One restrict per request: the mute
+            'mute': check(joins, 'restrict_chat_member', joins['requests']),
+        },
+        # One restrict per link: the unmute
+        'starts': {'unmute': check(starts, 'restrict_chat_member', args.requests)},
+    }
+
+
+def bench_migrate(args):
+    def summary(result):
+        keys = ('seconds', 'requests_per_second', 'request_to_mute', 'migration_seconds')
+        spans = ('db.queue', 'db.add_muted_user', 'db.run_background_batch')
+        return {
+            **{key: result[key] for key in keys if key in result},
+            'spans': {name: result['spans'][name] for name in spans if name in result['spans']},
+        }
+
+    baseline = run_scenario(args, lambda args: seed_users(args.users), scenario_joins)
+    migrating = run_scenario(args, seed_migrate, scenario_migrate)
+    return {
+        'benchmark': 'migrate',
+        'users': args.users,
+        'requests': args.requests,
+        'batch_size': stellar.MIGRATION_BATCH_SIZE,
+        'baseline': summary(baseline),
+        'with_migration': summary(migrating),
+    }
+
+
+def bench_starts(args):
+    return run_scenario(args, seed_starts, scenario_starts)
+
+
+def bench_broadcast(args):
+    return run_scenario(args, seed_broadcast, scenario_broadcast)
+
+
+async def concurrent_floods(hits):
+    """Let ``hits`` calls hit the same FloodWait together; return the outbound rate afterwards"""
+    scheduler = stellar.OutboundScheduler(chat_intervals={})
+
+    async def flooded():
+        raise FloodWait(value=1)
+
+    await asyncio.gather(*(scheduler.call('approve', None, flooded) for _ in range(hits)), return_exceptions=True)
+    rate = scheduler.limiter.rate
+    await scheduler.stop()
+    return rate
+
+
+def bench_floods(args):
+    configure(args)
+    halved = stellar.OUTBOUND_RATE / 2
+    concurrent = {hits: asyncio.run(concurrent_floods(hits)) for hits in (1, 8, 32)}
+    args.outbound_rate = stellar.OUTBOUND_RATE
+    floodwait_rate = args.floodwait_rate or 0.02
+    joins = {}
+    for name, args.floodwait_rate in (('without_floods', 0.0), ('with_floods', floodwait_rate)):
+        result = run_scenario(args, lambda args: None, scenario_joins)
+        joins[name] = {key: result[key] for key in ('seconds', 'requests_per_second', 'pipeline')}
+    return {
+        'benchmark': 'floods',
+        'requests': args.requests,
+        'outbound_rate': stellar.OUTBOUND_RATE,
+        'floodwait_rate': floodwait_rate,
+        'rate_after_concurrent_hits': concurrent,
+        'ok': all(rate == halved for rate in concurrent.values()),
+        **joins,
+    }
+
+
+def parity_calls(args):
+    """A seeded random sequence of ``(method, *args)`` storage calls covering every method"""
+    rng = random.Random(args.seed)
+    users = max(args.users // 10, 100)
+    now = 1700000000.0
+    calls = []
+    for step in range(200):
+        batch = [(rng.randint(1, users), None, f'user{step}', '2024-01-01T00:00:00') for _ in range(rng.randint(1, 50))]
+        calls.append(('write_batch', batch, {'total_requests': len(batch), 'total_unmuted': step % 3}))
+        failures = {rng.randint(1, users): rng.choice(('blocked', 'deleted')) for _ in range(rng.randint(0, 30))}
+        delivered = [rng.randint(1, users) for _ in range(rng.randint(0, 30))]
+        calls.append(('record_delivery_results', failures, [user_id for user_id in delivered if user_id not in failures]))
+        mutes = [
+            (rng.randint(1, users), -rng.randint(1, 20), f'chat{step}', '2024-01-01T00:00:00',
+             None if rng.random() < 0.2 else now + step + rng.random())
+            for _ in range(rng.randint(1, 20))
+        ]
+        calls.append(('add_muted_users', mutes))
+        user_id = rng.randint(1, users)
+        calls.append(('get_muted_users', user_id))
+        calls.append(('get_muted_users', user_id, -rng.randint(1, 20)))
+        calls.append(('remove_muted_user', user_id, -rng.randint(1, 20)))
+        calls.append(('add_sudo_user', rng.randint(1, 50), 1, '2024-01-01T00:00:00'))
+        calls.append(('remove_sudo_user', rng.randint(1, 50)))
+        if step % 10 == 9:
+            calls.append(('get_expired_mutes', now + step - 5, 25))
+            calls.append(('purge_expired', now + step - 5))
+            keys = [(rng.randint(1, users), -rng.randint(1, 20)) for _ in range(50)]
+            calls.append(('filter_expired_mutes', keys, now + step))
+            calls.append(('count_users', True))
+            calls.append(('count_users', False))
+            calls.append(('get_user_ids_page', rng.randint(0, users), 100, rng.random() < 0.5))
+            calls.append(('get_sudo_user_ids',))
+            calls.append(('count_muted_users',))
+            calls.append(('get_stats',))
+        if step % 50 == 49:
+            calls.append(('prune_dead_users', step == 199))
+    calls.append(('iter_muted_users',))
+    return calls
+
+
+def run_parity(engine, calls):
+    """Apply ``calls`` to ``engine`` and return every result in a comparable form"""
+    results = []
+    for method, *call_args in calls:
+        if method == 'purge_expired':
+            # Purge what get_expired_mutes found, as ExpiryScheduler does
+            rows = engine.get_expired_mutes(call_args[0], 25)
+            result = engine.purge_muted_users(rows)
+        else:
+            result = getattr(engine, method)(*call_args)
+        if method in ('get_sudo_user_ids', 'iter_muted_users'):
+            result = sorted(result)
+        elif isinstance(result, list):
+            result = [tuple(row.values()) if isinstance(row, dict) else row for row in result]
+        results.append(result)
+    return results
+
+
+def bench_parity(args):
+    calls = parity_calls(args)
+    engines = {'memory': stellar.MemoryStorage}
+    dsn = args.postgres_dsn or os.environ.get('STELLAR_POSTGRES_DSN')
+    if dsn:
+        engines['postgres'] = functools.partial(stellar.PostgresStorage, dsn)
+    runs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        configure(args)
+        use_temp_database(directory)
+        for name, factory in [('sqlite', stellar.SQLiteStorage)] + list(engines.items()):
+            engine = factory()
+            engine.open()
+            try:
+                if name == 'postgres':
+                    engine._call(engine.pool.execute(
+                        'TRUNCATE users, sudo_users, muted_users; '
+                        'UPDATE stats SET total_requests = 0, total_messages_sent = 0, total_unmuted = 0'
+                    ))
+                started = time.perf_counter()
+                results = run_parity(engine, calls)
+                runs[name] = {'seconds': time.perf_counter() - started, 'results': results}
+            finally:
+                engine.close()
+        stellar.close_database()
+
+    reference = runs['sqlite']['results']
+    report = {'benchmark': 'parity', 'calls': len(calls), 'engines': {}}
+    for name, run in runs.items():
+        mismatches = [
+            {'call': repr(calls[index])[:200], 'sqlite': repr(expected)[:200], name: repr(got)[:200]}
+            for index, (expected, got) in enumerate(zip(reference, run['results']))
+            if expected != got
+        ]
+        report['engines'][name] = {
+            'seconds': round(run['seconds'], 3),
+            'calls_per_second': round(len(calls) / run['seconds'], 1),
+            'mismatches': len(mismatches),
+            'first_mismatches': mismatches[:5],
+        }
+    report['ok'] = all(engine['mismatches'] == 0 for engine in report['engines'].values())
+    return report
+
+
+BENCHMARKS = {
+    'memory': bench_memory,
+    'joins': bench_joins,
+    'starts': bench_starts,
+    'startup': bench_startup,
+    'broadcast': bench_broadcast,
+    'migrate': bench_migrate,
+    'duplicates': bench_duplicates,
+    'priority': bench_priority,
+    'parity': bench_parity,
+    'floods': bench_floods,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--users', type=int, default=None, help='synthetic users to seed (memory, broadcast)')
+    parser.add_argument('--requests', type=int, default=10000, help='join requests or /start links to send')
+    parser.add_argument('--chats', type=int, default=10, help='groups the requests are spread over')
+    parser.add_argument('--shards', type=int, default=1, help='shard processes for the joins benchmark')
+    parser.add_argument('--delivery', choices=('partitioned', 'claiming'), default='partitioned',
+                        help='how sharded joins are split: by chat id, or by claiming each update')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0, help='share of joins and /start updates delivered twice')
+    parser.add_argument('--invalid-ratio', type=float, default=0.0, help='share of /start links that are invalid or used')
+    parser.add_argument('--pending-index', choices=('exact', 'bloom', 'off'), default='exact',
+                        help='how stellar.PENDING holds pending verifications (starts)')
+    parser.add_argument('--latency', type=float, default=20, help='mean fake API latency in ms')
+    parser.add_argument('--floodwait-rate', type=float, default=0.0, help='probability an API call raises FloodWait')
+    parser.add_argument('--floodwait-seconds', type=int, default=1, help='FloodWait duration')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability an API call raises an error')
+    parser.add_argument('--rate', type=float, default=1000000, help='broadcast rate limit in messages per second')
+    parser.add_argument('--outbound-rate', type=float, default=1000000, help='OUTBOUND_RATE for the run')
+    parser.add_argument('--group-interval', type=float, default=0, help='OUTBOUND_GROUP_INTERVAL for the run')
+    parser.add_argument('--welcome-window', type=float, default=stellar.WELCOME_COALESCE_WINDOW)
+    parser.add_argument('--retry-delay', type=float, default=0.05, help='JOIN_RETRY_DELAY for the run')
+    parser.add_argument('--storage', choices=sorted(stellar.STORAGE_ENGINES), default='sqlite',
+                        help='STORAGE_BACKEND for the run')
+    parser.add_argument('--postgres-dsn', default='', help='PostgreSQL for --storage postgres and parity (emptied!)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--startup-child', metavar='DATABASE', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.users is None:
+        args.users = 1000000 if args.benchmark == 'memory' else 100000
+    json.dump(BENCHMARKS[args.benchmark](args), sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()